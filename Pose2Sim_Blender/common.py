@@ -13,6 +13,15 @@
 
 ## INIT
 import bpy
+import numpy as np
+
+# y-up to z-up: (x, y, z) -> (x, -z, y), i.e. 90° rotation around x
+ZUP_AXES = np.array([0,2,1])
+ZUP_SIGNS = np.array([1.,-1.,1.])
+Q_ZUP = np.array([np.cos(np.pi/4), np.sin(np.pi/4), 0, 0]) # as a quaternion (w, x, y, z)
+ZUP_AXES.setflags(write=False)
+ZUP_SIGNS.setflags(write=False)
+Q_ZUP.setflags(write=False)
 
 
 ## AUTHORSHIP INFORMATION
@@ -58,4 +67,109 @@ def createMaterial(color=(0.8, 0.8, 0.8, 1), metallic = 0.5, roughness = 0.5):
         matg.metallic = metallic
         matg.roughness = roughness
     
-    return matg
\ No newline at end of file
+    return matg
+
+def quat_multiply(q1, q2):
+    '''
+    Hamilton product of two quaternions, or of two arrays of quaternions
+
+    INPUTS:
+    - q1, q2: quaternions (w, x, y, z) along the last axis
+
+    OUTPUT:
+    - q: product q1*q2, same layout
+    '''
+
+    w1, x1, y1, z1 = np.moveaxis(q1, -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(q2, -1, 0)
+    q = np.stack([w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                  w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                  w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                  w1*z2 + x1*y2 - y1*x2 + z1*w2], axis=-1)
+    
+    return q
+
+
+def quat_to_euler_xyz(q):
+    '''
+    Convert unit quaternions to Blender 'XYZ' Euler angles
+    Closed-form conversion, no rotation matrix needed
+
+    INPUT:
+    - q: quaternions (w, x, y, z) along the last axis
+
+    OUTPUT:
+    - eul: Euler angles (rot_x, rot_y, rot_z) along the last axis, in radians
+    '''
+
+    w, x, y, z = np.moveaxis(q, -1, 0)
+    rot_x = np.arctan2(2*(w*x + y*z), 1 - 2*(x**2 + y**2))
+    rot_y = np.arcsin(np.clip(2*(w*y - z*x), -1, 1))
+    rot_z = np.arctan2(2*(w*z + x*y), 1 - 2*(y**2 + z**2))
+    eul = np.stack([rot_x, rot_y, rot_z], axis=-1)
+    
+    return eul
+
+
+def unwrap_euler(eul):
+    '''
+    Make XYZ Euler angles continuous over time,
+    as Blender does when matrix_world is set frame after frame:
+    - among the two equivalent solutions (x, y, z) and (x+pi, pi-y, z+pi),
+      keep the one closest to the previous frame (matters near y = +/- pi/2)
+    - remove 2*pi jumps
+
+    INPUT:
+    - eul: Euler angles, time along the first axis, (rot_x, rot_y, rot_z) along the last axis
+
+    OUTPUT:
+    - eul_unwrapped: continuous Euler angles, same shape
+    '''
+
+    eul_unwrapped = np.array(eul, dtype=float)
+    for t in range(1, len(eul_unwrapped)):
+        prev = eul_unwrapped[t-1]
+        candidates = np.stack([eul_unwrapped[t], eul_unwrapped[t]*[1,-1,1] + np.pi])
+        candidates += 2*np.pi * np.round((prev - candidates) / (2*np.pi))
+        dist = np.abs(candidates - prev).sum(axis=-1)
+        eul_unwrapped[t] = np.where((dist[1] < dist[0])[...,None], candidates[1], candidates[0])
+
+    return eul_unwrapped
+
+
+def set_keyframes(obj, data_path, frames, values):
+    '''
+    Insert keyframes for all frames at once, one fcurve per axis.
+    Much faster than calling obj.keyframe_insert at each frame.
+
+    INPUTS:
+    - obj: Blender object to animate
+    - data_path: animated property ('location', 'rotation_euler', 'scale')
+    - frames: 1D array of frame numbers
+    - values: 2D array of property values (one row per frame, one column per axis)
+    '''
+
+    if obj.animation_data is None:
+        obj.animation_data_create()
+    action = obj.animation_data.action
+    if action is None:
+        action = bpy.data.actions.new(f'{obj.name}Action')
+        obj.animation_data.action = action
+
+    for idx in range(values.shape[1]):
+        # get or create fcurve: slotted actions since Blender 4.4, legacy action.fcurves before
+        if hasattr(action, 'fcurve_ensure_for_datablock'):
+            fcurve = action.fcurve_ensure_for_datablock(obj, data_path, index=idx)
+        else:
+            fcurve = action.fcurves.find(data_path, index=idx)
+            if fcurve is None:
+                fcurve = action.fcurves.new(data_path, index=idx, action_group='Object Transforms')
+        fcurve.keyframe_points.clear() # replace previous keyframes if any
+
+        # interleave frames and values: [frame0, value0, frame1, value1, ...]
+        co = np.empty(2*len(frames), dtype=np.float32)
+        co[0::2] = frames
+        co[1::2] = values[:,idx]
+        fcurve.keyframe_points.add(len(frames))
+        fcurve.keyframe_points.foreach_set('co', co)
+        fcurve.update()
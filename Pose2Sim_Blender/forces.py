@@ -21,9 +21,9 @@
 
 ## INIT
 import bpy
-from mathutils import Vector
 import numpy as np
 import os
+from .common import set_keyframes, quat_multiply, quat_to_euler_xyz, unwrap_euler, ZUP_AXES, ZUP_SIGNS, Q_ZUP
 
 direction = 'zup'
 SIZE = 1/1000
@@ -56,27 +56,44 @@ def load_grf(grf_path):
     - grf_header: time and force names (v: 3*value, p: 3*position, m: 3*moment)
     '''
 
-    # read data
-    grf_data_np = np.loadtxt(grf_path, skiprows=7)
-    
-    # read marker names
+    # read force names and data in a single pass
     with open(grf_path) as f:
-        for i, line in enumerate(f):
-            if i == 5:
-                grf_header = f.readline().strip().split('\t')
-            elif i > 5:
-                break
+        for i in range(6):
+            f.readline()
+        grf_header = f.readline().strip().split('\t')
+        grf_data_np = np.loadtxt(f)
     grf_header = [g.strip() for g in grf_header]
     
     return grf_data_np, grf_header
 
 
-def addForce(force_collection, forceName='', text="FORCE", color=COLOR):        
+def load_arrow_mesh():
+    '''
+    Import the arrow .stl file once,
+    so that its mesh can be shared by all force arrows
+
+    OUTPUT:
+    - arrow_mesh: mesh data of the arrow
+    '''
+
+    # find imported object by difference, no need to deselect the whole scene
+    objects_before = set(bpy.context.scene.objects)
+    bpy.ops.import_mesh.stl(filepath=arrowFile)
+    imported_objects = [ o for o in bpy.context.scene.objects if o not in objects_before ]
+    arrow_mesh = imported_objects[0].data
+    arrow_mesh.materials.append(None) # material slot, filled per object
+    bpy.data.objects.remove(imported_objects[0])
+
+    return arrow_mesh
+
+
+def addForce(force_collection, arrow_mesh, forceName='', text="FORCE", color=COLOR):        
     '''
     Add one force vector to the scene
 
     INPUTS:
     - force_collection: collection to add the force to
+    - arrow_mesh: arrow mesh data, shared between forces
     - text: force name (default: "MARKER")
     - color: marker color (default: COLOR)
 
@@ -96,15 +113,11 @@ def addForce(force_collection, forceName='', text="FORCE", color=COLOR):
     #Add arrow    
     arrow = bpy.data.objects.new(forceName,None)
     force_collection.objects.link(arrow)
-    for obj in bpy.data.objects:
-        obj.select_set(False)
-    bpy.ops.import_mesh.stl(filepath=arrowFile)
-    selected_objects = [ o for o in bpy.context.scene.objects if o.select_get() ]
-    obj=selected_objects[0]
+    obj = bpy.data.objects.new('arrow', arrow_mesh)
     obj.scale=(1,.5,.5)
     obj.parent=arrow
-    obj.users_collection[0].objects.unlink(obj)
-    obj.active_material = matg
+    obj.material_slots[0].link = 'OBJECT' # mesh is shared, material is not
+    obj.material_slots[0].material = matg
     force_collection.objects.link(obj)
     
 
@@ -134,30 +147,57 @@ def import_forces(grf_path, direction='zup', target_framerate=30):
     # bpy.data.scenes['Scene'].render.fps = fps
         
     # create forces
+    # collection only linked to the scene once filled, so that adding arrows does not trigger scene updates
     force_collection = bpy.data.collections.new('Forces')
-    bpy.context.scene.collection.children.link(force_collection)
+    arrow_mesh = load_arrow_mesh()
     for forceName in grfNames:        
-        addForce(force_collection, forceName=forceName, text=forceName)
-
-    # create arrows
-    x_unit_arrow=Vector([1,0,0])
-    # H_zup = np.array([[0,0,1,0], [1,0,0,0], [0,1,0,0], [0,0,0,1]])
-    H_zup = np.array([[1,0,0,0], [0,0,-1,0], [0,1,0,0], [0,0,0,1]])
-    for n in range(0, len(times), conv_fac_frame_rate):
-        for i, f in enumerate(grfNames):
-            T = grf_data_np[n, 1+3+9*i : 1+3+9*i+3]
-            grf_vec = grf_data_np[n, 1+9*i : 1+9*i+3]
-            R = (x_unit_arrow.rotation_difference( Vector(grf_vec).normalized() )).to_matrix()
-            H = np.block([ [R,T.reshape(3,1)], [np.zeros(3), 1] ])
-            if direction=='zup':
-                H = H_zup @ H
-            scale_arrow = [Vector(grf_vec).magnitude*SIZE, 1, 1]
-            obj = force_collection.objects[f]
-            obj.matrix_world = H.T
-            obj.scale = scale_arrow
-            obj.keyframe_insert('location', frame=int(n/conv_fac_frame_rate)+1)
-            obj.keyframe_insert('rotation_euler', frame=int(n/conv_fac_frame_rate)+1)
-            obj.keyframe_insert('scale', frame=int(n/conv_fac_frame_rate)+1)
+        addForce(force_collection, arrow_mesh, forceName=forceName, text=forceName)
+    bpy.context.scene.collection.children.link(force_collection)
+
+    # compute arrow locations, rotations, and scales for all frames at once
+    grf_data_np = grf_data_np[::conv_fac_frame_rate]
+    nb_frames, nb_forces = len(grf_data_np), len(grfNames)
+    vec_start = [grf_header.index(f+'_vx') for f in grfNames]
+    loc_start = []
+    for f, v in zip(grfNames, vec_start):
+        if f+'_px' in grf_header:
+            loc_start.append(grf_header.index(f+'_px'))
+        else: # standard layout: vx, vy, vz, px, py, pz, ...
+            print(f'Could not find {f}_px in {grf_path}, using the 3 columns after {f}_vz as point of application.')
+            loc_start.append(v+3)
+    vec_idx = np.array(vec_start)[:,None] + np.arange(3)
+    loc_idx = np.array(loc_start)[:,None] + np.arange(3)
+    grf_vec = grf_data_np[:,vec_idx.ravel()].reshape(nb_frames, nb_forces, 3)
+    grf_loc = grf_data_np[:,loc_idx.ravel()].reshape(nb_frames, nb_forces, 3)
+    grf_mag = np.linalg.norm(grf_vec, axis=-1)
+
+    # rotation from x unit arrow to force direction (null forces keep pointing along x)
+    grf_dir = np.zeros_like(grf_vec)
+    grf_dir[...,0] = 1
+    np.divide(grf_vec, grf_mag[...,None], out=grf_dir, where=grf_mag[...,None]>0)
+    # closed-form shortest arc quaternion from x: (1+dx, 0, -dz, dy), normalized
+    grf_quat_raw = np.stack([1+grf_dir[...,0], np.zeros_like(grf_mag), -grf_dir[...,2], grf_dir[...,1]], axis=-1)
+    grf_quat_norm = np.linalg.norm(grf_quat_raw, axis=-1, keepdims=True)
+    grf_quat = np.zeros_like(grf_quat_raw)
+    grf_quat[...,3] = 1 # arrow pointing backwards: half turn around z
+    np.divide(grf_quat_raw, grf_quat_norm, out=grf_quat, where=grf_quat_norm>0)
+
+    # y-up to z-up
+    if direction=='zup':
+        grf_quat = quat_multiply(Q_ZUP, grf_quat)
+        grf_loc = grf_loc[...,ZUP_AXES] * ZUP_SIGNS # axis swap, no matrix product
+    grf_rot = unwrap_euler(quat_to_euler_xyz(grf_quat)) # no 2*pi jumps between keyframes
+    grf_scale = np.ones_like(grf_loc)
+    grf_scale[...,0] = grf_mag*SIZE
+
+    # animate arrows, all frames at once
+    frames = np.arange(nb_frames) + 1
+    for i, f in enumerate(grfNames):
+        obj = force_collection.objects[f]
+        set_keyframes(obj, 'location', frames, grf_loc[:,i])
+        set_keyframes(obj, 'rotation_euler', frames, grf_rot[:,i])
+        set_keyframes(obj, 'scale', frames, grf_scale[:,i])
+    bpy.context.scene.frame_set(bpy.context.scene.frame_current) # refresh scene at current frame
 
     # hide axes
     bpy.ops.object.select_by_type(extend=False, type='EMPTY')
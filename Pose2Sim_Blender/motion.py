@@ -32,7 +32,7 @@
 import os
 import numpy as np
 import bpy
-from .common import ShowMessageBox
+from .common import ShowMessageBox, set_keyframes, quat_multiply, quat_to_euler_xyz, unwrap_euler, ZUP_AXES, ZUP_SIGNS, Q_ZUP
 
 direction = 'zup'
 export_to_csv = True
@@ -113,88 +113,71 @@ def apply_mot_to_model(mot_path, osim_path, direction='zup', target_framerate='a
         # coordinates = [model_coordSet.get(i) for i in range(model_coordSet.getSize())]
         coordinateNames = motion_data.getColumnLabels()
         motion_data_np = motion_data.getMatrix().to_numpy()
-        for i, c in enumerate(coordinateNames):
-            try:
-                if model_coordSet.get(c).getMotionType() == 1: # 1: rotation, 2: translation, 3: coupled
-                    if  motion_data.getTableMetaDataAsString('inDegrees') == 'yes':
-                        motion_data_np[:,i] = motion_data_np[:,i] * np.pi/180 # if rotation, convert to radians
-            except:
-                pass
+        coord_handles = [(c, model_coordSet.get(coord)) for c, coord in enumerate(coordinateNames) if model_coordSet.contains(coord)] # looked up once
+        try:
+            in_degrees = motion_data.getTableMetaDataAsString('inDegrees') == 'yes'
+        except:
+            in_degrees = False
+        if in_degrees:
+            rot_cols = [c for c, coord in coord_handles if coord.getMotionType() == 1] # 1: rotation, 2: translation, 3: coupled
+            motion_data_np[:,rot_cols] *= np.pi/180 # all rotation columns at once
         
         # animate model
         state = model.initSystem()
-        loc_rot_frame_all = []
-        # H_zup = np.array([[0,0,1,0], [1,0,0,0], [0,1,0,0], [0,0,0,1]])
-        H_zup = np.array([[1,0,0,0], [0,0,-1,0], [0,1,0,0], [0,0,0,1]])
+        frame_ids = range(0, len(times), conv_fac_frame_rate)
+        Q_all = np.empty((len(frame_ids), len(bodies), 4))
+        loc_rot_frame_all_np = np.empty((len(frame_ids), 1+6*len(bodies))) # time column, then x, y, z, rotx, roty, rotz per body
+        loc_rot_frame_all_np[:,0] = times[::conv_fac_frame_rate]
+        loc_rot = loc_rot_frame_all_np[:,1:].reshape(len(frame_ids), len(bodies), 6) # view, filled in place
         
-        # print('Time frame:')
-        for n in range(0, len(times), conv_fac_frame_rate):
-            # print(times[n], 's')
+        for t, n in enumerate(frame_ids):
             # set model struct in each time state
-            for c, coord in enumerate(coordinateNames): ## PROBLEME QUAND HEADERS DE MOTION_DATA_NP ET COORDINATENAMES SONT PAS DANS LE MEME ORDRE
-                try:
-                    model.getCoordinateSet().get(coord).setValue(state, motion_data_np[n,c], enforceContraints=False)
-                except:
-                    pass
+            for c, coord in coord_handles:
+                coord.setValue(state, motion_data_np[n,c], enforceContraints=False)
             # model.assemble(state)
             model.realizePosition(state) # much faster (IK already done, no need to compute it again)
             
             # use state of model to get body coordinates in ground
-            loc_rot_frame = []
-            for b in bodies:
+            for i, b in enumerate(bodies):
                 H_swig = b.getTransformInGround(state)
-                T = H_swig.T().to_numpy()
-                R_swig = H_swig.R()
-                R = np.array([[R_swig.get(0,0), R_swig.get(0,1), R_swig.get(0,2)],
-                    [R_swig.get(1,0), R_swig.get(1,1), R_swig.get(1,2)],
-                    [R_swig.get(2,0), R_swig.get(2,1), R_swig.get(2,2)]])
-                H = np.block([ [R,T.reshape(3,1)], [np.zeros(3), 1] ])
-                
-                # y-up to z-up
-                if direction=='zup':
-                    H = H_zup @ H
-                
-                # convert matrix to loc and rot, and export to csv
-                if export_to_csv:
-                    loc_x, loc_y, loc_z = H[0:3,3]
-                    R_mat = H[0:3,0:3]
-                    sy = np.sqrt(R_mat[1,0]**2 +  R_mat[0,0]**2) # singularity when y angle is +/- pi/2
-                    if sy>1e-6:
-                        rot_x = np.arctan2(R_mat[2,1], R_mat[2,2])
-                        rot_y = np.arctan2(-R_mat[2,0], sy)
-                        rot_z = np.arctan2(R_mat[1,0], R_mat[0,0])
-                    else: # to be verified
-                        rot_x = np.arctan2(-R_mat[1,2], R_mat[1,1])
-                        rot_y = np.arctan2(-R[2,0], sy)
-                        rot_z = 0
-                    loc_rot_frame.extend([loc_x, loc_y, loc_z, rot_x, rot_y, rot_z])
-            
-                # set coordinates of blender bodies to this state
-                b_iterated = [o.name for o in collection.objects if o.name.startswith(b.getName())][0]
-                obj=collection.objects[b_iterated]
-                obj.matrix_world = H.T
-                obj.keyframe_insert('location',frame=int(n/conv_fac_frame_rate))
-                obj.keyframe_insert('rotation_euler',frame=int(n/conv_fac_frame_rate))
-            
-            if export_to_csv:
-                loc_rot_frame_all.append(loc_rot_frame)
+                loc_rot[t,i,:3] = H_swig.T().to_numpy()
+                Q_swig = H_swig.R().convertRotationToQuaternion()
+                Q_all[t,i] = [Q_swig.get(0), Q_swig.get(1), Q_swig.get(2), Q_swig.get(3)] # (w, x, y, z)
+
+        # y-up to z-up
+        if direction=='zup':
+            Q_all = quat_multiply(Q_ZUP, Q_all)
+            loc_rot[...,:3] = loc_rot[...,ZUP_AXES] * ZUP_SIGNS # axis swap, no matrix product
+
+        # convert quaternions to euler angles, all frames and bodies at once
+        loc_rot[...,3:] = quat_to_euler_xyz(Q_all)
+        loc_rot[...,3:] = unwrap_euler(loc_rot[...,3:]) # no 2*pi jumps between keyframes
+
+        # set keyframes of blender bodies, all frames at once
+        frames = np.arange(len(loc_rot))
+        for i, b in enumerate(bodyNames):
+            b_iterated = [o.name for o in collection.objects if o.name.startswith(b)][0]
+            obj=collection.objects[b_iterated]
+            set_keyframes(obj, 'location', frames, loc_rot[:,i,:3])
+            set_keyframes(obj, 'rotation_euler', frames, loc_rot[:,i,3:])
 
         # export to csv
         if export_to_csv:
-            loc_rot_frame_all_np = np.array(loc_rot_frame_all)
-            loc_rot_frame_all_np = np.insert(loc_rot_frame_all_np, 0, times[::conv_fac_frame_rate], axis=1) # insert time column
             bodyHeader = 'times, ' + ''.join([f'{b}_x, {b}_y, {b}_z, {b}_rotx, {b}_roty, {b}_rotz, ' for b in bodyNames])[:-2]
-            np.savetxt(os.path.splitext(mot_path)[0]+'.csv', loc_rot_frame_all_np, delimiter=',', header=bodyHeader)
+            np.savetxt(os.path.splitext(mot_path)[0]+'.csv', loc_rot_frame_all_np, delimiter=',', header=bodyHeader, fmt='%.8g') # faster to write and smaller than default '%.18e'
         
 
     # If chosen file is .csv (body positions and rotations)
     elif os.path.splitext(mot_path)[1] == '.csv':
-        # read csv motion file
-        loc_rot_frame_all_np = np.loadtxt(mot_path, delimiter=",", dtype=float, skiprows=1)
+        # read csv motion file, header and data in a single pass
         with open(mot_path) as f:
             csv_header = f.readline()
+            loc_rot_frame_all_np = np.loadtxt(f, delimiter=",", dtype=float)
         bodyNames = csv_header.split(',')[1::6]
         bodyNames = [b[1:-2] for b in bodyNames]
+        if loc_rot_frame_all_np.shape[1] != 1 + 6*len(bodyNames):
+            ShowMessageBox("Csv header and data columns do not match", "Invalid csv motion file")
+            raise ValueError(f'{len(bodyNames)} bodies in header but {loc_rot_frame_all_np.shape[1]} columns in {mot_path}.')
 
         # set framerate
         bpy.context.scene.render.fps = target_framerate
@@ -203,21 +186,17 @@ def apply_mot_to_model(mot_path, osim_path, direction='zup', target_framerate='a
         fps = int((len(times)-1) / (times[-1] - times[0]))
         conv_fac_frame_rate = int(np.round(fps / target_framerate))
 
-        # animate model
-        for n in range(0, len(times), conv_fac_frame_rate):
-            for i, b in enumerate(bodyNames):
-                loc_x = loc_rot_frame_all_np[n,6*i+1]
-                loc_y = loc_rot_frame_all_np[n,6*i+2]
-                loc_z = loc_rot_frame_all_np[n,6*i+3]
-                rot_x = loc_rot_frame_all_np[n,6*i+4]
-                rot_y = loc_rot_frame_all_np[n,6*i+5]
-                rot_z = loc_rot_frame_all_np[n,6*i+6]
-
-                b_nameiterated = [o.name for o in collection.objects if o.name.startswith(b)][0]
-                obj=collection.objects[b_nameiterated]
-                obj.location=loc_x,loc_y,loc_z
-                obj.rotation_euler=rot_x,rot_y,rot_z
-                obj.keyframe_insert('location',frame=int(n/conv_fac_frame_rate)+1)
-                obj.keyframe_insert('rotation_euler',frame=int(n/conv_fac_frame_rate)+1)
+        # animate model, all frames at once
+        loc_rot = loc_rot_frame_all_np[::conv_fac_frame_rate,1:].reshape(-1, len(bodyNames), 6) # (frames, bodies, 6)
+        loc_rot[...,3:] = unwrap_euler(loc_rot[...,3:]) # no 2*pi jumps between keyframes
+        frames = np.arange(len(loc_rot)) + 1
+        for i, b in enumerate(bodyNames):
+            b_nameiterated = [o.name for o in collection.objects if o.name.startswith(b)][0]
+            obj=collection.objects[b_nameiterated]
+            set_keyframes(obj, 'location', frames, loc_rot[:,i,:3])
+            set_keyframes(obj, 'rotation_euler', frames, loc_rot[:,i,3:])
+
+    # refresh scene at current frame
+    bpy.context.scene.frame_set(bpy.context.scene.frame_current)
 
     print(f'OpenSim motion imported from {mot_path}')